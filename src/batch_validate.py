@@ -3,13 +3,29 @@
 import argparse
 import csv
 import getpass
+import gzip
+import io
+import itertools
 import json
+import operator
 import os
 import re
 import requests
 import sys
 import time
 
+from scheduler import RequestScheduler
+
+# The ImmPort API base URLs, which can be overridden to point at a stand-in server:
+API_URL = os.environ.get('IMMPORT_API_URL', 'https://api.immport.org')
+AUTH_URL = os.environ.get('IMMPORT_AUTH_URL', 'https://auth.immport.org')
+
+# Output configuration: rows are serialized in batches of WRITE_BATCH_SIZE, and each batch is
+# handed to a file with a WRITE_BUFFER_SIZE byte buffer.
+WRITE_BATCH_SIZE = 10000
+WRITE_BUFFER_SIZE = 1 << 20
+GZIP_LEVEL = 6
+
 
 def get_study_ids(studiesinfo, technique):
   """
@@ -40,22 +56,31 @@ def filter_study_ids(all_ids, requested_ids):
   return requested_ids
 
 
-def fetch_immport_data(auth_token, endpoint_name, sid, jsonpath):
+def fetch_auth_token(username, password):
   """
-  Fetches the data for the given `sid` from ImmPort, caching it in the file at the location
-  `jsonpath` for later reuse before returning the data to the caller.
+  Retrieve an authentication token from ImmPort using the given username and password.
   """
-  print("Fetching {} JSON data for {} from ImmPort ...".format(endpoint_name, sid))
-  # Send the request:
-  query = ("https://api.immport.org/data/query/result/{}?studyAccession={}"
-           .format(endpoint_name, sid))
-  resp = requests.get(query, headers={"Authorization": "bearer " + auth_token})
+  print("Retrieving authentication token from Immport ...")
+  resp = requests.post(AUTH_URL + '/auth/token',
+                       data={'username': username, 'password': password})
   if resp.status_code != requests.codes.ok:
     resp.raise_for_status()
+  return resp.json()['token']
+
+
+def fetch_immport_data(scheduler, endpoint_name, sid, jsonpath):
+  """
+  Fetches the data for the given `sid` from ImmPort using the given RequestScheduler, caching it in
+  the file at the location `jsonpath` for later reuse before returning the data to the caller.
+  """
+  print("Fetching {} JSON data for {} from ImmPort ...".format(endpoint_name, sid))
+  # Send the request:
+  query = ("{}/data/query/result/{}?studyAccession={}"
+           .format(API_URL, endpoint_name, sid))
+  data = scheduler.get_json(query)
 
   # Save the JSON data from the response, and write it to a file at the location `jsonpath` that
   # can be reused later if this script is called again.
-  data = resp.json()
   with open(jsonpath, 'w') as f:
     json.dump(data, f)
   return data
@@ -151,6 +176,106 @@ def validate(name, parents, taxid_names, scientific_names, synonyms, lowercase_n
   return comment
 
 
+def validate_records(records, headers, parents, taxid_names, scientific_names, synonyms,
+                     lowercase_names):
+  """
+  Generate an output row for each of the given records, for which their keys are given in
+  `headers`. In addition, validate the virus name for each record and append the validation
+  comments, and whether they match, to the row corresponding to the record.
+  """
+  # itemgetter() returns a bare value rather than a tuple when given a single key:
+  if len(headers) > 1:
+    get_fields = operator.itemgetter(*headers)
+  else:
+    def get_fields(record):
+      return tuple(record[header] for header in headers)
+  validated = {}
+  for record in records:
+    # Validate a given ('virusStrainReported', 'virusStrainPreferred') combination at most once:
+    validation_key = (record['virusStrainReported'], record['virusStrainPreferred'])
+    comments = validated.get(validation_key)
+    if comments is None:
+      comment_reported = validate(record['virusStrainReported'], parents, taxid_names,
+                                  scientific_names, synonyms, lowercase_names)
+      comment_preferred = validate(record['virusStrainPreferred'], parents, taxid_names,
+                                   scientific_names, synonyms, lowercase_names)
+      comments = (comment_reported, comment_preferred,
+                  'Y' if comment_reported == comment_preferred else 'N')
+      validated[validation_key] = comments
+
+    yield get_fields(record) + comments
+
+
+def open_output(outpath, compress=False):
+  """
+  Open the file at `outpath` for writing TSV text, with a large write buffer. If `compress` is
+  true, the output is gzip-compressed.
+  """
+  if compress:
+    return gzip.open(outpath, 'wt', newline='', compresslevel=GZIP_LEVEL)
+  return open(outpath, 'w', newline='', buffering=WRITE_BUFFER_SIZE)
+
+
+def write_tsv(outfile, rows):
+  """
+  Write the given rows to `outfile` as TSV, with every field quoted and embedded quotes escaped.
+  Rows are serialized in batches of `WRITE_BATCH_SIZE` so that each batch reaches `outfile` in a
+  single write call.
+  """
+  rows = iter(rows)
+  batch = io.StringIO()
+  writer = csv.writer(batch, delimiter='\t', quoting=csv.QUOTE_ALL, lineterminator='\n')
+  while True:
+    chunk = list(itertools.islice(rows, WRITE_BATCH_SIZE))
+    if not chunk:
+      break
+    writer.writerows(chunk)
+    outfile.write(batch.getvalue())
+    batch.seek(0)
+    batch.truncate()
+
+
+def write_parquet(outpath, columns, rows):
+  """
+  Write the given rows, whose fields are named by `columns`, to a Parquet file at `outpath`. The
+  column types are inferred from the first batch of rows: columns of numbers are stored as doubles,
+  columns of booleans as booleans, and all other columns as strings. Missing values are stored as
+  nulls. Rows are written in row groups of `WRITE_BATCH_SIZE`, so only one batch is held in memory
+  at a time. Requires pyarrow.
+  """
+  import pyarrow
+  import pyarrow.parquet
+
+  def infer_type(values):
+    kinds = {type(value) for value in values if value is not None}
+    if kinds == {bool}:
+      return pyarrow.bool_()
+    if kinds and kinds <= {int, float}:
+      return pyarrow.float64()
+    return pyarrow.string()
+
+  def to_array(column, values, type):
+    if type == pyarrow.string():
+      values = [None if value is None else str(value) for value in values]
+    try:
+      return pyarrow.array(values, type=type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError):
+      raise ValueError("Column '{}' has values that are not of type {}; use TSV output instead"
+                       .format(column, type))
+
+  rows = iter(rows)
+  chunk = list(itertools.islice(rows, WRITE_BATCH_SIZE))
+  columns_values = list(zip(*chunk)) or [[] for column in columns]
+  schema = pyarrow.schema([(column, infer_type(values))
+                           for column, values in zip(columns, columns_values)])
+  with pyarrow.parquet.ParquetWriter(outpath, schema) as writer:
+    while chunk:
+      arrays = [to_array(field.name, values, field.type)
+                for field, values in zip(schema, zip(*chunk))]
+      writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+      chunk = list(itertools.islice(rows, WRITE_BATCH_SIZE))
+
+
 def write_records(records, headers, outfile, parents, taxid_names,
                   scientific_names, synonyms, lowercase_names):
   """
@@ -158,27 +283,8 @@ def write_records(records, headers, outfile, parents, taxid_names,
   In addition, validate the virus name for each record and write the validation comment to the row
   corresponding to the record in the file.
   """
-  validated = {}
-  for record in records:
-    for header in headers:
-      print('"{}"'.format(record[header]), end='\t', file=outfile)
-
-    # Validate a given ('virusStrainReported', 'virusStrainPreferred') combination at most once:
-    validation_key = (record['virusStrainReported'], record['virusStrainPreferred'])
-    if validation_key not in validated:
-      validated[validation_key] = {
-        'comment_reported': validate(record['virusStrainReported'], parents, taxid_names,
-                                     scientific_names, synonyms, lowercase_names),
-        'comment_preferred': validate(record['virusStrainPreferred'], parents, taxid_names,
-                                      scientific_names, synonyms, lowercase_names)}
-
-    comment_reported = validated[validation_key]['comment_reported']
-    comment_preferred = validated[validation_key]['comment_preferred']
-    print('"{}"\t"{}"'.format(comment_reported, comment_preferred), end='\t', file=outfile)
-    if comment_reported == comment_preferred:
-      print('"Y"', file=outfile)
-    else:
-      print('"N"', file=outfile)
+  write_tsv(outfile, validate_records(records, headers, parents, taxid_names, scientific_names,
+                                      synonyms, lowercase_names))
 
 
 def main():
@@ -188,12 +294,13 @@ def main():
   studies and/or a list of study IDs corresponding to Neutralizing Antibody Titer (neutAbTiter)
   studies. For each of the study ids of a given type, its details are fetched from ImmPort and the
   virus name reported in the study is validated using the given NCBI nodes.dmp and names.dmp files.
-  The output of this script is a series of CSV files, for each given study type, reporting on the
-  virus names used in the studies specified. In each report, the virus name reported in the study as
-  well as the 'preferred name' of the virus (i.e. the name automatically generated by ImmPort
-  when the study was submitted) are indcated. In addition to these columns, this script adds three
-  extra columns: (a) the result of validating the reported virus name, (b) the result of validating
-  the preferred virus name, and (c) a comparison of the results of these two validations.''')
+  The output of this script is a series of TSV (or Parquet) files, for each given study type,
+  reporting on the virus names used in the studies specified. In each report, the virus name
+  reported in the study as well as the 'preferred name' of the virus (i.e. the name automatically
+  generated by ImmPort when the study was submitted) are indcated. In addition to these columns,
+  this script adds three extra columns: (a) the result of validating the reported virus name, (b)
+  the result of validating the preferred virus name, and (c) a comparison of the results of these
+  two validations.''')
 
   parser.add_argument('studiesinfo', type=argparse.FileType(mode='r', encoding='ISO-8859-1'),
                       help='A TSV file containing general information on various studies')
@@ -205,6 +312,11 @@ def main():
                       help='directory for output TSV files')
   parser.add_argument('cache_dir', type=str,
                       help='directory containing cached JSON files')
+  parser.add_argument('--format', choices=['tsv', 'parquet'], default='tsv',
+                      help=('output file format (default: tsv); parquet requires pyarrow, and '
+                            'infers column types from the first rows'))
+  parser.add_argument('--gzip', action='store_true',
+                      help='gzip-compress TSV output files')
 
   # Command-line arguments used to specify the study ids to validate.
   # ---
@@ -234,6 +346,19 @@ def main():
     print("At least one study type must be specified")
     sys.exit(1)
 
+  if args['format'] == 'parquet':
+    try:
+      import pyarrow.parquet  # noqa: F401
+    except ImportError:
+      print("Parquet output requires pyarrow (pip install pyarrow)")
+      sys.exit(1)
+    if args['gzip']:
+      print("--gzip applies only to TSV output")
+      sys.exit(1)
+    extension = 'parquet'
+  else:
+    extension = 'tsv.gz' if args['gzip'] else 'tsv'
+
   # If the username and/or password haven't been set in environment variables, prompt for them:
   username = os.environ.get('IMMPORT_USERNAME')
   if not username:
@@ -253,18 +378,15 @@ def main():
   parents = extract_nodes(args['nodes'])
   taxid_names, scientific_names, synonyms, lowercase_names = extract_names(args['names'])
 
-  # Get an authentication token from ImmPort:
-  print("Retrieving authentication token from Immport ...")
-  resp = requests.post('https://auth.immport.org/auth/token',
-                       data={'username': username, 'password': password})
-  if resp.status_code != requests.codes.ok:
-    resp.raise_for_status()
-  auth_token = resp.json()['token']
+  # Get an authentication token from ImmPort. All requests go through the scheduler, which limits
+  # their rate, retries transient errors, and fetches a new token when the current one expires:
+  scheduler = RequestScheduler(lambda: fetch_auth_token(username, password))
+  scheduler.get_token()
 
   # Now request data for the given study ids, for each endpoint:
   for endpoint in endpoints:
     print("Validating {} studies".format(endpoint['name']))
-    outpath = os.path.normpath('{}/{}.tsv'.format(args['output_dir'], endpoint['name']))
+    outpath = os.path.normpath('{}/{}.{}'.format(args['output_dir'], endpoint['name'], extension))
     # Find all of the studies corresponding to the given endpoint to validate:
     study_ids = get_study_ids(studiesinfo, endpoint['description'])
     # But validate only those that the user has requested (validate them all if none are specified):
@@ -272,46 +394,54 @@ def main():
       study_ids = filter_study_ids(study_ids, args[endpoint['name']])
 
     data = {}
+    uncached = []
+    cachedir = '{}/{}/'.format(args['cache_dir'], endpoint['name'])
+    os.makedirs(cachedir, exist_ok=True)
     for sid in study_ids:
-      cachedir = '{}/{}/'.format(args['cache_dir'], endpoint['name'])
-      os.makedirs(cachedir, exist_ok=True)
       jsonpath = os.path.normpath('{}/{}.json'.format(cachedir, sid))
       # Check to see if there is an existing file for this study id. If so, reuse it, otherwise
-      # send an API call to ImmPort to retrieve the data:
+      # queue an API call to ImmPort to retrieve the data:
       try:
         with open(jsonpath) as f:
           data[sid] = json.load(f)
           print("Retrieved JSON data for {} from cached file {}".format(sid, jsonpath))
       except FileNotFoundError:
         print("No cached data for {} found ({} does not exist)".format(sid, jsonpath))
-        data[sid] = fetch_immport_data(auth_token, endpoint['name'], sid, jsonpath)
+        uncached.append((sid, jsonpath))
+
+    fetched = scheduler.map(
+      lambda item: fetch_immport_data(scheduler, endpoint['name'], *item), uncached)
+    for (sid, jsonpath), sid_data in zip(uncached, fetched):
+      data[sid] = sid_data
 
     if not any([data[sid] for sid in data]):
       print("No data found for endpoint '{}'".format(endpoint['name']))
       continue
 
-    # Write the header of the output TSV file by using the data returned plus extra fields
-    # determined on its basis. Every sid in the data set should have the same fields, so we can just
-    # use the first one (that has data) to get the header fields from. We can assume that there will
-    # be at least one of these since we checked for this above.
+    # Write the header of the output file by using the data returned plus extra fields determined
+    # on its basis. Every sid in the data set should have the same fields, so we can just use the
+    # first one (that has data) to get the header fields from. We can assume that there will be at
+    # least one of these since we checked for this above.
     first_sid_with_data = [sid for sid in data if data[sid]].pop()
     headers = sorted([key for key in data[first_sid_with_data][0]])
-    with open(outpath, 'w') as outfile:
-      for header in headers:
-        print('"{}"'.format(header), end='\t', file=outfile)
-      print('"Comment on virusStrainReported"', end='\t', file=outfile)
-      print('"Comment on virusStrainPreferred"', end='\t', file=outfile)
-      print('"Comments match"', file=outfile)
-
-      # Now write the actual data:
+    columns = headers + ['Comment on virusStrainReported', 'Comment on virusStrainPreferred',
+                         'Comments match']
+
+    def generate_rows():
       for sid in study_ids:
         records = data.get(sid)
         if not records:
           print("No data found for " + sid)
           continue
         print("Processing {} records for {} ID: {}".format(len(records), endpoint['name'], sid))
-        write_records(records, headers, outfile, parents, taxid_names, scientific_names,
-                      synonyms, lowercase_names)
+        yield from validate_records(records, headers, parents, taxid_names, scientific_names,
+                                    synonyms, lowercase_names)
+
+    if args['format'] == 'parquet':
+      write_parquet(outpath, columns, generate_rows())
+    else:
+      with open_output(outpath, compress=args['gzip']) as outfile:
+        write_tsv(outfile, itertools.chain([columns], generate_rows()))
 
   end = time.time()
   print("Processing completed. Total execution time: {0:.2f} seconds.".format(end - start))
@@ -344,3 +474,14 @@ def test_validate():
 
   comment = validate('FO', parents, taxid_names, scientific_names, synonyms, lowercase_names)
   assert comment == 'Not the name of a virus'
+
+
+def test_write_tsv():
+  rows = [['a', 'say "hi"', 'tab\there'], ['b', None, 3]]
+  outfile = io.StringIO()
+  write_tsv(outfile, rows)
+  assert outfile.getvalue() == '"a"\t"say ""hi"""\t"tab\there"\n"b"\t""\t"3"\n'
+
+  outfile.seek(0)
+  assert list(csv.reader(outfile, delimiter='\t')) == [
+    ['a', 'say "hi"', 'tab\there'], ['b', '', '3']]
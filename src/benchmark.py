@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the HIPC validation scripts. Each benchmark runs on synthetic data, so no ImmPort
+# credentials or NCBI downloads are needed.
+#
+# Usage:
+#   ./benchmark.py write [--rows N]
+#   ./benchmark.py fetch [--studies N] [--error-rate R] [--latency S]
+#   ./benchmark.py endtoend [--studies N] [--records N] [--latency S]
+
+import argparse
+import contextlib
+import csv
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+import batch_validate
+import fetch
+import mock_immport
+import scheduler
+
+from scheduler import RequestScheduler
+
+# A small synthetic taxonomy, in the form returned by batch_validate.extract_nodes() and
+# batch_validate.extract_names():
+parents = {'10239': '1', '11320': '10239', '9606': '1'}
+taxid_names = {'10239': 'Viruses', '11320': 'Influenza A virus', '9606': 'Homo sapiens'}
+scientific_names = {name: taxid for taxid, name in taxid_names.items()}
+synonyms = {'flu A': '11320', 'human': '9606'}
+lowercase_names = {name.lower(): taxid for name, taxid in
+                   list(scientific_names.items()) + list(synonyms.items())}
+taxonomy = (parents, taxid_names, scientific_names, synonyms, lowercase_names)
+
+
+def make_records(count):
+  """Return `count` synthetic hai records, spread over 50 studies."""
+  return [mock_immport.titer_record('SDY{}'.format(i % 50), i) for i in range(count)]
+
+
+def legacy_write_records(records, headers, outfile, parents, taxid_names,
+                         scientific_names, synonyms, lowercase_names):
+  """The print()-per-field implementation of batch_validate.write_records(), for comparison."""
+  validate = batch_validate.validate
+  validated = {}
+  for record in records:
+    for header in headers:
+      print('"{}"'.format(record[header]), end='\t', file=outfile)
+    validation_key = (record['virusStrainReported'], record['virusStrainPreferred'])
+    if validation_key not in validated:
+      validated[validation_key] = {
+        'comment_reported': validate(record['virusStrainReported'], parents, taxid_names,
+                                     scientific_names, synonyms, lowercase_names),
+        'comment_preferred': validate(record['virusStrainPreferred'], parents, taxid_names,
+                                      scientific_names, synonyms, lowercase_names)}
+    comment_reported = validated[validation_key]['comment_reported']
+    comment_preferred = validated[validation_key]['comment_preferred']
+    print('"{}"\t"{}"'.format(comment_reported, comment_preferred), end='\t', file=outfile)
+    if comment_reported == comment_preferred:
+      print('"Y"', file=outfile)
+    else:
+      print('"N"', file=outfile)
+
+
+def report(label, rows, seconds, path=None):
+  size = ' {:>8.1f} MB'.format(os.path.getsize(path) / 1e6) if path else ''
+  print('{:<28} {:>12,.0f} rows/sec{}'.format(label, rows / seconds, size))
+
+
+def bench_write(rows):
+  """Compare the rows/sec of the old and new batch_validate.write_records() output stages."""
+  records = make_records(rows)
+  headers = sorted(records[0])
+  columns = headers + ['Comment on virusStrainReported', 'Comment on virusStrainPreferred',
+                       'Comments match']
+  print('Writing {:,} records'.format(rows))
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'legacy.tsv')
+    start = time.perf_counter()
+    with open(path, 'w') as outfile:
+      legacy_write_records(records, headers, outfile, *taxonomy)
+    report('before: print() per field', rows, time.perf_counter() - start, path)
+
+    path = os.path.join(tmpdir, 'hai.tsv')
+    start = time.perf_counter()
+    with batch_validate.open_output(path) as outfile:
+      batch_validate.write_records(records, headers, outfile, *taxonomy)
+    report('after: tsv', rows, time.perf_counter() - start, path)
+
+    path = os.path.join(tmpdir, 'hai.tsv.gz')
+    start = time.perf_counter()
+    with batch_validate.open_output(path, compress=True) as outfile:
+      batch_validate.write_records(records, headers, outfile, *taxonomy)
+    report('after: tsv.gz', rows, time.perf_counter() - start, path)
+
+    path = os.path.join(tmpdir, 'hai.parquet')
+    start = time.perf_counter()
+    try:
+      batch_validate.write_parquet(
+        path, columns, batch_validate.validate_records(records, headers, *taxonomy))
+      report('after: parquet', rows, time.perf_counter() - start, path)
+    except ImportError:
+      print('{:<28} skipped (pyarrow is not installed)'.format('after: parquet'))
+
+
+def bench_fetch(studies, error_rate, latency):
+  """
+  Measure the studies/sec fetched through a RequestScheduler from a local mock ImmPort server that
+  injects errors, latency and token expiry.
+  """
+  print('Fetching {:,} studies, error rate {}, mean latency {}s'
+        .format(studies, error_rate, latency))
+  sids = ['SDY{}'.format(i) for i in range(studies)]
+  for workers in [1, 4, 8, 16]:
+    with mock_immport.MockImmPort(error_rate=error_rate, latency=latency, token_ttl=2,
+                                  retry_after=0, seed=0) as server:
+      def authenticate():
+        resp = requests.post(server.url + '/auth/token', data={'username': '', 'password': ''})
+        resp.raise_for_status()
+        return resp.json()['token']
+
+      requester = RequestScheduler(authenticate, rate=1000, burst=100, max_workers=workers,
+                                   backoff_base=0.05, backoff_max=1.0)
+      url = server.url + '/data/query/result/hai'
+      start = time.perf_counter()
+      for _ in requester.map(lambda sid: requester.get_json(url, params={'studyAccession': sid}),
+                             sids):
+        pass
+      seconds = time.perf_counter() - start
+    print('{:>2} workers {:>10,.1f} studies/sec  {:>5} retries  {:>3} reauthentications'
+          .format(workers, studies / seconds, requester.stats['retries'],
+                  requester.stats['reauthentications']))
+
+
+def write_taxonomy(nodes_path, names_path):
+  """Write the synthetic taxonomy as NCBI nodes.dmp and names.dmp files."""
+  with open(nodes_path, 'w') as f:
+    for taxid, parent in parents.items():
+      f.write('{}\t|\t{}\t|\tno rank\t|\n'.format(taxid, parent))
+  with open(names_path, 'w') as f:
+    for taxid, name in taxid_names.items():
+      f.write('{}\t|\t{}\t|\t\t|\tscientific name\t|\n'.format(taxid, name))
+    for name, taxid in synonyms.items():
+      f.write('{}\t|\t{}\t|\t\t|\tsynonym\t|\n'.format(taxid, name))
+
+
+def bench_end_to_end(studies, records, latency):
+  """
+  Measure the throughput of fetch.py's fetch and table actions and of batch_validate.py, run
+  against a local stand-in ImmPort server.
+  """
+  print('{:,} studies, {:,} records per study, mean latency {}s'
+        .format(studies, records, latency))
+  sids = ['SDY{}'.format(i) for i in range(1, studies + 1)]
+
+  def run(label, rows, func, *args):
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+      func(*args)
+    seconds = time.perf_counter() - start
+    print('{:<38} {:>8.2f} s {:>12,.0f} rows/sec'.format(label, seconds, rows / seconds))
+
+  with mock_immport.MockImmPort(records=records, latency=latency) as server, \
+       tempfile.TemporaryDirectory() as tmpdir:
+    # Point the scripts at the stand-in server, and restore their settings afterwards:
+    saved = (os.getcwd(), sys.argv, dict(os.environ), scheduler.RATE_LIMIT,
+             fetch.API_URL, fetch.AUTH_URL, batch_validate.API_URL, batch_validate.AUTH_URL)
+    os.environ.setdefault('IMMPORT_USERNAME', 'benchmark')
+    os.environ.setdefault('IMMPORT_PASSWORD', 'benchmark')
+    scheduler.RATE_LIMIT = 1000
+    fetch.API_URL = fetch.AUTH_URL = server.url
+    batch_validate.API_URL = batch_validate.AUTH_URL = server.url
+    os.chdir(tmpdir)
+    try:
+      # fetch.load_studies() reads the list of studies from this file:
+      with open('ImmPort_shared_studies_10292020101903_all.txt', 'w') as f:
+        w = csv.writer(f, delimiter='\t', lineterminator='\n')
+        w.writerow(['study_accession'])
+        w.writerows([sid] for sid in sids)
+      for endpoint in fetch.endpoints:
+        run('fetch.py fetch {}'.format(endpoint), studies * records, fetch.fetch, endpoint)
+        run('fetch.py table {}'.format(endpoint), studies * records, fetch.table, endpoint)
+
+      with open('HIPC_Studies.tsv', 'w') as f:
+        w = csv.writer(f, delimiter='\t', lineterminator='\n')
+        w.writerow(['Supporting Data', 'Experiment Measurement Techniques'])
+        w.writerows([sid, 'Hemagglutination Inhibition, Virus Neutralization'] for sid in sids)
+      write_taxonomy('nodes.dmp', 'names.dmp')
+      os.makedirs('build')
+      sys.argv = ['batch_validate.py', 'HIPC_Studies.tsv', 'nodes.dmp', 'names.dmp', 'build',
+                  'cache', '--hai', '--neutAbTiter']
+      run('batch_validate.py (fetch, hai+neut)', 2 * studies * records,
+          batch_validate.main)
+      run('batch_validate.py (cached, hai+neut)', 2 * studies * records,
+          batch_validate.main)
+    finally:
+      (cwd, sys.argv, environ, scheduler.RATE_LIMIT,
+       fetch.API_URL, fetch.AUTH_URL, batch_validate.API_URL, batch_validate.AUTH_URL) = saved
+      os.environ.clear()
+      os.environ.update(environ)
+      os.chdir(cwd)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the HIPC validation scripts')
+  subparsers = parser.add_subparsers(dest='benchmark')
+  subparsers.required = True
+  write_parser = subparsers.add_parser('write', help='batch_validate output serialization')
+  write_parser.add_argument('--rows', type=int, default=1000000,
+                            help='number of records to write (default: 1000000)')
+  fetch_parser = subparsers.add_parser('fetch', help='ImmPort requests against a mock server')
+  fetch_parser.add_argument('--studies', type=int, default=200,
+                            help='number of studies to fetch (default: 200)')
+  fetch_parser.add_argument('--error-rate', type=float, default=0.05,
+                            help='fraction of requests that fail (default: 0.05)')
+  fetch_parser.add_argument('--latency', type=float, default=0.05,
+                            help='mean response latency in seconds (default: 0.05)')
+  endtoend_parser = subparsers.add_parser(
+    'endtoend', help='fetch.py and batch_validate.py against a stand-in ImmPort server')
+  endtoend_parser.add_argument('--studies', type=int, default=100,
+                               help='number of studies (default: 100)')
+  endtoend_parser.add_argument('--records', type=int, default=1000,
+                               help='number of records per study (default: 1000)')
+  endtoend_parser.add_argument('--latency', type=float, default=0.05,
+                               help='mean response latency in seconds (default: 0.05)')
+  args = parser.parse_args()
+
+  if args.benchmark == 'write':
+    bench_write(args.rows)
+  elif args.benchmark == 'fetch':
+    bench_fetch(args.studies, args.error_rate, args.latency)
+  elif args.benchmark == 'endtoend':
+    bench_end_to_end(args.studies, args.records, args.latency)
+
+
+if __name__ == '__main__':
+  main()
@@ -2,13 +2,20 @@
 
 import argparse
 import csv
+import getpass
 import json
 import os
 import requests
 
+from scheduler import RequestScheduler
+
+# The ImmPort API base URLs, which can be overridden to point at a stand-in server:
+API_URL = os.environ.get("IMMPORT_API_URL", "https://api.immport.org")
+AUTH_URL = os.environ.get("IMMPORT_AUTH_URL", "https://auth.immport.org")
+
 endpoints = {
     "immune_exposure": {
-        "url": "https://api.immport.org/data/query/immune_exposure",
+        "path": "/data/query/immune_exposure",
         "columns": [
             "subjectAccession",
             "exposureAccession",
@@ -25,7 +32,7 @@ endpoints = {
         ],
     },
     "fcsAnalyzed": {
-        "url": "https://api.immport.org/data/query/result/fcsAnalyzed",
+        "path": "/data/query/result/fcsAnalyzed",
         "columns": [
             "studyAccession",
             "experimentAccession",
@@ -61,62 +68,67 @@ def load_sids():
     return sids
 
 
-def fetch_auth_token():
+def get_credentials():
     """
-    Retrieve an authentication token from ImmPort using the given username and password.
+    Return the ImmPort username and password from the environment, prompting for any that are not
+    set.
     """
-    print("Retrieving authentication token from ImmPort ...")
-
     username = os.environ.get('IMMPORT_USERNAME')
     if not username:
         username = input("IMMPORT_USERNAME not set. Enter ImmPort username: ")
     password = os.environ.get('IMMPORT_PASSWORD')
     if not password:
         password = getpass.getpass('IMMPORT_PASSWORD not set. Enter ImmPort password: ')
+    return username, password
+
 
-    resp = requests.post('https://auth.immport.org/auth/token',
+def fetch_auth_token(username, password):
+    """
+    Retrieve an authentication token from ImmPort using the given username and password.
+    """
+    print("Retrieving authentication token from ImmPort ...")
+    resp = requests.post(AUTH_URL + '/auth/token',
                        data={'username': username, 'password': password})
     if resp.status_code != requests.codes.ok:
         resp.raise_for_status()
     return resp.json()['token']
 
 
-def fetch_data(auth_token, endpoint, sids=None):
-    """Fetch data for a specific endpoint and optional list of study IDs."""
+def fetch_data(scheduler, endpoint, sids=None):
+    """
+    Fetch data for a specific endpoint and optional list of study IDs, using the given
+    RequestScheduler.
+    """
     if endpoint in endpoints:
-        url = endpoints[endpoint]["url"]
+        url = API_URL + endpoints[endpoint]["path"]
     else:
         raise Exception(f"Unknown endpoint '{endpoint}'")
     if sids:
         url += "?studyAccession="
         url += ",".join(sids)
     print(url)
-    resp = requests.get(url, headers={"Authorization": "bearer " + auth_token})
-    if resp.status_code != requests.codes.ok:
-        resp.raise_for_status()
-    return resp.json()
+    return scheduler.get_json(url)
 
 
 def fetch(endpoint):
     """Fetch and cache data for all HIPC studies and a given endpoint."""
-    auth_token = fetch_auth_token()
+    # Read the credentials once, so that re-authenticating from a worker thread never prompts:
+    username, password = get_credentials()
+    scheduler = RequestScheduler(lambda: fetch_auth_token(username, password))
+    scheduler.get_token()
 
     directory = os.path.join("data", endpoint)
     os.makedirs(directory, exist_ok=True)
 
-    sids = load_sids()
-    for sid in sids:
-        jsonpath = f"{directory}/{sid}.json"
-        if os.path.exists(jsonpath):
-            continue
-        try:
-            data = fetch_data(auth_token, endpoint, [sid])
-        except Exception:
-            auth_token = fetch_auth_token()
-            data = fetch_data(auth_token, endpoint, [sid])
-        with open(jsonpath, 'w') as f:
+    def fetch_sid(sid):
+        data = fetch_data(scheduler, endpoint, [sid])
+        with open(f"{directory}/{sid}.json", 'w') as f:
             json.dump(data, f, indent=2)
 
+    sids = [sid for sid in load_sids() if not os.path.exists(f"{directory}/{sid}.json")]
+    for _ in scheduler.map(fetch_sid, sids):
+        pass
+
 
 def table(endpoint):
     directory = os.path.join("data", endpoint)
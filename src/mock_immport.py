@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+#
+# A local stand-in for the ImmPort auth and data query APIs, for testing and benchmarking offline.
+# It serves synthetic hai, neutAbTiter, fcsAnalyzed and immune_exposure records, with a
+# configurable number of records per study. Responses are delayed by a configurable latency, a
+# configurable fraction of them fail with 429, 500 or 503, and auth tokens expire after a
+# configurable time.
+#
+# Usage:
+#   ./mock_immport.py --port 8080 --records 1000 --error-rate 0.1 --latency 0.2 --token-ttl 60
+#
+# Then point fetch.py and batch_validate.py at it with:
+#   export IMMPORT_API_URL=http://127.0.0.1:8080 IMMPORT_AUTH_URL=http://127.0.0.1:8080
+
+import argparse
+import json
+import random
+import socketserver
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+strains = ['Influenza A virus', 'influenza a virus', 'flu A', 'Homo sapiens', 'H1N1 "Cal" 2009',
+           'A/California/7/2009\tH1N1', None]
+
+
+def titer_record(sid, i):
+  """Return synthetic hai or neutAbTiter record number `i` for the given study."""
+  return {
+    'armAccession': 'ARM{}'.format(i % 500),
+    'expsampleAccession': 'ES{}'.format(i),
+    'studyAccession': sid,
+    'studyTimeCollected': i % 28,
+    'subjectAccession': 'SUB{}'.format(i % 5000),
+    'valuePreferred': float(i % 2048),
+    'valueReported': str(i % 2048),
+    'virusStrainPreferred': strains[i % len(strains)],
+    'virusStrainReported': strains[(i * 3) % len(strains)],
+  }
+
+
+def fcs_analyzed_record(sid, i):
+  """Return synthetic fcsAnalyzed record number `i` for the given study."""
+  populations = ['CD4+ T cell', 'CD8+ T cell', 'B cell', 'NK cell', 'CD3+CD4+CD25hi']
+  definitions = ['CD3+CD4+', 'CD3+CD8+', 'CD19+', 'CD3-CD56+', 'CD3+CD4+CD25++']
+  return {
+    'studyAccession': sid,
+    'experimentAccession': 'EXP{}'.format(i % 50),
+    'populationNameReported': populations[i % len(populations)],
+    'populationNamePreferred': populations[(i + 1) % len(populations)],
+    'populationDefnitionReported': definitions[i % len(definitions)],
+    'populationDefnitionPreferred': definitions[(i + 1) % len(definitions)],
+  }
+
+
+def immune_exposure_record(sid, i):
+  """Return synthetic immune_exposure record number `i` for the given study."""
+  processes = ['vaccination', 'infectious agent exposure', 'occurrence of infectious disease']
+  materials = [('VO_0000044', 'Fluzone'), ('VO_0000047', 'FluMist'), ('', 'saline')]
+  diseases = [('DOID:8469', 'influenza'), ('DOID:0080600', 'COVID-19'), ('', '')]
+  material_id, material = materials[i % len(materials)]
+  disease_id, disease = diseases[i % len(diseases)]
+  return {
+    'studyAccession': sid,
+    'subjectAccession': 'SUB{}'.format(i % 5000),
+    'exposureAccession': 'EX{}'.format(i),
+    'exposureProcessPreferred': processes[i % len(processes)],
+    'exposureProcessReported': processes[i % len(processes)].upper(),
+    'exposureMaterialId': material_id,
+    'exposureMaterialPreferred': material,
+    'exposureMaterialReported': material.lower(),
+    'diseaseOntologyId': disease_id,
+    'diseasePreferred': disease,
+    'diseaseReported': disease.title(),
+    'diseaseStagePreferred': 'acute' if i % 2 else None,
+    'diseaseStageReported': 'Acute' if i % 2 else None,
+  }
+
+
+record_generators = {
+  'hai': titer_record,
+  'neutAbTiter': titer_record,
+  'fcsAnalyzed': fcs_analyzed_record,
+  'immune_exposure': immune_exposure_record,
+}
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+  # http.server.ThreadingHTTPServer is only available from Python 3.7.
+  daemon_threads = True
+
+
+class MockImmPort:
+  """
+  Serve the mock ImmPort API on `host` and `port` (port 0 picks a free port) in a background
+  thread. Use as a context manager, or call start() and stop().
+  """
+
+  def __init__(self, host='127.0.0.1', port=0, records=10, error_rate=0.0, latency=0.0,
+               token_ttl=None, retry_after=1, seed=None):
+    self.records_per_study = records
+    self.error_rate = error_rate
+    self.latency = latency
+    self.token_ttl = token_ttl
+    self.retry_after = retry_after
+    self.random = random.Random(seed)
+    self.random_lock = threading.Lock()
+    self.tokens = {}
+    self.tokens_lock = threading.Lock()
+    self.payloads = {}
+    self.httpd = ThreadingHTTPServer((host, port), MockImmPortHandler)
+    self.httpd.mock = self
+    self.thread = None
+
+  @property
+  def url(self):
+    host, port = self.httpd.server_address[:2]
+    return 'http://{}:{}'.format(host, port)
+
+  def issue_token(self):
+    """Return a new auth token."""
+    token = uuid.uuid4().hex
+    with self.tokens_lock:
+      self.tokens[token] = time.monotonic()
+    return token
+
+  def token_valid(self, token):
+    with self.tokens_lock:
+      issued = self.tokens.get(token)
+    if issued is None:
+      return False
+    return self.token_ttl is None or time.monotonic() - issued < self.token_ttl
+
+  def draw(self):
+    """Return a (delay, error status or None) pair for the next data response."""
+    with self.random_lock:
+      delay = self.random.uniform(0, 2 * self.latency)
+      error = None
+      if self.random.random() < self.error_rate:
+        error = self.random.choice([429, 500, 503])
+    return delay, error
+
+  def records(self, endpoint, sids):
+    """
+    Return `records_per_study` synthetic records for each of the given study IDs, or None if the
+    endpoint is unknown.
+    """
+    generate = record_generators.get(endpoint)
+    if not generate:
+      return None
+    return [generate(sid, i) for sid in sids for i in range(self.records_per_study)]
+
+  def payload(self, endpoint, sids):
+    """
+    Return the JSON-encoded records for the given endpoint and study IDs, or None if the endpoint
+    is unknown. Payloads are cached, so that repeated requests measure the client, not the server.
+    """
+    key = (endpoint, tuple(sids))
+    if key not in self.payloads:
+      records = self.records(endpoint, sids)
+      self.payloads[key] = None if records is None else json.dumps(records).encode('utf-8')
+    return self.payloads[key]
+
+  def start(self):
+    self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+    self.thread.join()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+
+class MockImmPortHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def send_json(self, status, data, headers=None):
+    self.send_body(status, json.dumps(data).encode('utf-8'), headers)
+
+  def send_body(self, status, body, headers=None):
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    mock = self.server.mock
+    length = int(self.headers.get('Content-Length', 0))
+    self.rfile.read(length)
+    if urlparse(self.path).path != '/auth/token':
+      self.send_json(404, {'error': 'Not found'})
+      return
+    self.send_json(200, {'token': mock.issue_token()})
+
+  def do_GET(self):
+    mock = self.server.mock
+    url = urlparse(self.path)
+    if not url.path.startswith('/data/query/'):
+      self.send_json(404, {'error': 'Not found'})
+      return
+
+    auth = self.headers.get('Authorization', '')
+    if not mock.token_valid(auth[len('bearer '):]):
+      self.send_json(401, {'error': 'Invalid or expired token'})
+      return
+
+    delay, error = mock.draw()
+    time.sleep(delay)
+    if error == 429:
+      self.send_json(429, {'error': 'Too many requests'},
+                     headers={'Retry-After': str(mock.retry_after)})
+      return
+    if error:
+      self.send_json(error, {'error': 'Server error'})
+      return
+
+    endpoint = url.path.rsplit('/', 1)[-1]
+    sids = []
+    for value in parse_qs(url.query).get('studyAccession', []):
+      sids.extend(value.split(','))
+    body = mock.payload(endpoint, sids)
+    if body is None:
+      self.send_json(404, {'error': 'Unknown endpoint'})
+      return
+    self.send_body(200, body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Serve a stand-in ImmPort API for offline testing')
+  parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+  parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+  parser.add_argument('--records', type=int, default=10,
+                      help='number of records returned per study (default: 10)')
+  parser.add_argument('--error-rate', type=float, default=0.0,
+                      help='fraction of data requests that fail with 429, 500 or 503')
+  parser.add_argument('--latency', type=float, default=0.0,
+                      help='mean response latency in seconds')
+  parser.add_argument('--token-ttl', type=float, default=None,
+                      help='seconds after which auth tokens expire (default: never)')
+  parser.add_argument('--retry-after', type=int, default=1,
+                      help='Retry-After value sent with 429 responses')
+  args = parser.parse_args()
+
+  server = MockImmPort(args.host, args.port, args.records, args.error_rate, args.latency,
+                       args.token_ttl, args.retry_after)
+  print('Serving stand-in ImmPort API at {}'.format(server.url))
+  try:
+    server.httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
+
+
+# Unit tests:
+
+def test_records():
+  server = MockImmPort(records=3)
+  try:
+    records = server.records('hai', ['SDY1', 'SDY2'])
+    assert [record['studyAccession'] for record in records] == ['SDY1'] * 3 + ['SDY2'] * 3
+    assert set(server.records('immune_exposure', ['SDY1'])[0]) >= {'exposureAccession'}
+    assert server.payload('unknown', ['SDY1']) is None
+  finally:
+    server.httpd.server_close()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+#
+# A request scheduler for the ImmPort APIs. All requests go through a single RequestScheduler,
+# which:
+#
+# - limits the request rate with a token bucket,
+# - retries connection errors, 429 and 5xx responses with exponential backoff and full jitter,
+#   honouring any Retry-After header,
+# - adapts the number of concurrent requests to the observed latency and error rate (additive
+#   increase, multiplicative decrease),
+# - re-authenticates in one place when the auth token expires, so that concurrent requests
+#   share a single new token.
+
+import os
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+AUTH_STATUS_CODES = {401}
+
+# Default request rate (per second) and maximum concurrency, which can be overridden for tuning:
+RATE_LIMIT = float(os.environ.get('IMMPORT_RATE_LIMIT', 10))
+MAX_WORKERS = int(os.environ.get('IMMPORT_MAX_WORKERS', 8))
+
+
+class TokenBucket:
+  """Allow `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """Block until a token is available, then take it."""
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+class RequestScheduler:
+  """
+  Send authenticated requests to ImmPort. `authenticate` is a function that takes no arguments
+  and returns a new auth token; it is called for the first request and again whenever ImmPort
+  rejects the current token.
+  """
+
+  def __init__(self, authenticate, rate=None, burst=10, max_workers=None, max_retries=6,
+               backoff_base=0.5, backoff_max=30.0, target_latency=5.0, timeout=120,
+               session=None):
+    rate = rate or RATE_LIMIT
+    max_workers = max_workers or MAX_WORKERS
+    self.authenticate = authenticate
+    self.bucket = TokenBucket(rate, burst)
+    self.max_workers = max_workers
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.target_latency = target_latency
+    self.timeout = timeout
+    self.session = session or requests.Session()
+
+    self.token = None
+    self.token_lock = threading.Lock()
+
+    # Adaptive concurrency: at most int(self.limit) requests are in flight at once.
+    self.limit = float(max_workers)
+    self.in_flight = 0
+    self.slots = threading.Condition()
+
+    self.stats = {'requests': 0, 'retries': 0, 'reauthentications': 0}
+    self.stats_lock = threading.Lock()
+
+  def get_token(self, stale_token=None):
+    """
+    Return the current auth token. If `stale_token` is given and is still the current token,
+    fetch a new one first. Concurrent callers with the same stale token share one new token.
+    """
+    with self.token_lock:
+      if self.token is None or self.token == stale_token:
+        if self.token is not None:
+          self.count('reauthentications')
+        self.token = self.authenticate()
+      return self.token
+
+  def count(self, key):
+    with self.stats_lock:
+      self.stats[key] += 1
+
+  def acquire_slot(self):
+    with self.slots:
+      while self.in_flight >= int(self.limit):
+        self.slots.wait()
+      self.in_flight += 1
+
+  def release_slot(self, latency, ok):
+    """Release a concurrency slot and adjust the limit given the outcome of the request."""
+    with self.slots:
+      self.in_flight -= 1
+      if ok and latency <= self.target_latency:
+        self.limit = min(self.max_workers, self.limit + 1 / self.limit)
+      else:
+        self.limit = max(1.0, self.limit / 2)
+      self.slots.notify_all()
+
+  def backoff(self, attempt, resp=None):
+    """Return the number of seconds to wait before retry number `attempt`."""
+    if resp is not None:
+      try:
+        return min(self.backoff_max, float(resp.headers['Retry-After']))
+      except (KeyError, ValueError):
+        pass
+    return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+  def request(self, method, url, **kwargs):
+    """
+    Send a request, retrying transient failures and re-authenticating as needed, and return the
+    response. Raise an exception if the request still fails after `max_retries` retries.
+    """
+    token = self.get_token()
+    attempt = 0
+    while True:
+      self.bucket.acquire()
+      self.acquire_slot()
+      start = time.monotonic()
+      resp = None
+      try:
+        self.count('requests')
+        resp = self.session.request(method, url, timeout=self.timeout,
+                                    headers={"Authorization": "bearer " + token}, **kwargs)
+      except (requests.ConnectionError, requests.Timeout):
+        if attempt >= self.max_retries:
+          raise
+      finally:
+        ok = resp is not None and resp.status_code not in RETRY_STATUS_CODES
+        self.release_slot(time.monotonic() - start, ok)
+
+      if resp is not None:
+        retry = resp.status_code in RETRY_STATUS_CODES or resp.status_code in AUTH_STATUS_CODES
+        if not retry or attempt >= self.max_retries:
+          resp.raise_for_status()
+          return resp
+        # The token has expired, so get a new one and retry straight away:
+        if resp.status_code in AUTH_STATUS_CODES:
+          token = self.get_token(stale_token=token)
+          attempt += 1
+          continue
+
+      self.count('retries')
+      time.sleep(self.backoff(attempt, resp))
+      attempt += 1
+
+  def get_json(self, url, **kwargs):
+    """GET the given URL and return the decoded JSON response."""
+    return self.request('GET', url, **kwargs).json()
+
+  def map(self, func, items):
+    """
+    Call `func` on each item using up to `max_workers` threads, and return an iterator over the
+    results in order. Requests made by `func` through this scheduler share its rate and
+    concurrency limits.
+    """
+    with ThreadPoolExecutor(self.max_workers) as executor:
+      yield from executor.map(func, items)
+
+
+# Unit tests:
+
+def test_request_scheduler():
+  import mock_immport
+
+  with mock_immport.MockImmPort(error_rate=0.3, latency=0.01, token_ttl=0.3, retry_after=0,
+                                seed=1) as server:
+    def authenticate():
+      resp = requests.post(server.url + '/auth/token', data={'username': 'u', 'password': 'p'})
+      resp.raise_for_status()
+      return resp.json()['token']
+
+    scheduler = RequestScheduler(authenticate, rate=1000, burst=50, max_workers=4,
+                                 backoff_base=0.001, backoff_max=0.01, max_retries=20)
+    sids = ['SDY{}'.format(i) for i in range(40)]
+    results = list(scheduler.map(
+      lambda sid: scheduler.get_json(server.url + '/data/query/result/hai',
+                                     params={'studyAccession': sid}), sids))
+
+  assert [result[0]['studyAccession'] for result in results] == sids
+  assert scheduler.stats['retries'] > 0
+  assert scheduler.stats['reauthentications'] > 0
+  assert 1 <= scheduler.limit <= 4
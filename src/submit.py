@@ -5,14 +5,122 @@
 
 # To run in development mode, do:
 # export FLASK_DEBUG=1
+#
+# Workbooks are validated in a pool of worker processes, forked after the NCBI Taxonomy has been
+# loaded, so that a large upload does not stall other requests. Each job is limited in time and
+# memory. The limits can be set with these environment variables:
+# - SUBMIT_WORKERS: number of worker processes (default: number of CPUs)
+# - SUBMIT_QUEUE_TIMEOUT: seconds a workbook may wait for a free worker (default: 30)
+# - SUBMIT_JOB_TIMEOUT: seconds allowed per workbook, once a worker starts it (default: 60)
+# - SUBMIT_JOB_MEMORY: bytes of memory allowed per workbook (default: 1 GiB)
 
 
 from flask import Flask, request, render_template, redirect
+from flask.helpers import get_debug_flag
 import datetime
+import multiprocessing
 import os
+import resource
+import signal
+import time
 import validate
 
+WORKERS = int(os.environ.get('SUBMIT_WORKERS', os.cpu_count() or 1))
+QUEUE_TIMEOUT = int(os.environ.get('SUBMIT_QUEUE_TIMEOUT', 30))
+JOB_TIMEOUT = int(os.environ.get('SUBMIT_JOB_TIMEOUT', 60))
+JOB_MEMORY = int(os.environ.get('SUBMIT_JOB_MEMORY', 1 << 30))
+
+# Extra seconds to wait for a worker after its job timeout, before giving up on it:
+GRACE_PERIOD = 5
+
 app = Flask(__name__)
+pool = None
+
+
+class JobTimeout(Exception):
+  pass
+
+
+class JobExpired(Exception):
+  pass
+
+
+def raise_timeout(signum, frame):
+  raise JobTimeout()
+
+
+def address_space():
+  """Return the current virtual memory size of this process in bytes, or 0 if unknown."""
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[0]) * resource.getpagesize()
+  except (OSError, ValueError, IndexError):
+    return 0
+
+
+def run_job(func, args, timeout, memory, start_by=None):
+  """
+  Call `func` with `args` in a worker process, allowing it `timeout` seconds and `memory` bytes of
+  memory beyond what the worker already uses. Raise JobTimeout or MemoryError if it exceeds them.
+  As a backstop for code that does not return to Python in time, the worker is killed with
+  SIGXCPU if the job uses `GRACE_PERIOD` seconds of CPU time more than its timeout.
+  If the worker only picks the job up after the time `start_by` (as returned by time.time()), the
+  caller has stopped waiting for it, so raise JobExpired without running it.
+  """
+  if start_by is not None and time.time() > start_by:
+    raise JobExpired()
+  as_limits = resource.getrlimit(resource.RLIMIT_AS)
+  cpu_limits = resource.getrlimit(resource.RLIMIT_CPU)
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  cpu_used = int(usage.ru_utime + usage.ru_stime)
+  if memory:
+    resource.setrlimit(resource.RLIMIT_AS, (address_space() + memory, as_limits[1]))
+  resource.setrlimit(resource.RLIMIT_CPU, (cpu_used + timeout + GRACE_PERIOD, cpu_limits[1]))
+  signal.signal(signal.SIGALRM, raise_timeout)
+  signal.alarm(timeout)
+  try:
+    return func(*args)
+  finally:
+    signal.alarm(0)
+    resource.setrlimit(resource.RLIMIT_AS, as_limits)
+    resource.setrlimit(resource.RLIMIT_CPU, cpu_limits)
+
+
+def start_pool(processes=WORKERS):
+  """
+  Fork the pool of worker processes. Call this after loading the taxonomy, so the workers share
+  it with this process rather than loading it again, and before starting the server, so that no
+  request threads exist yet. Workers are long-lived: run_job() restores their limits after each
+  job, and a replacement is only forked if a worker is killed by its CPU limit.
+  """
+  global pool
+  pool = multiprocessing.get_context('fork').Pool(processes)
+
+
+def process_workbook(in_path, out_path):
+  """
+  Validate the workbook at `in_path` in a worker process, writing the result to `out_path`.
+  Return an error response if no worker was free within QUEUE_TIMEOUT seconds or the job exceeded
+  its time or memory limits, otherwise None.
+  """
+  if pool is None:
+    # The pool has not been started, e.g. under `flask run`:
+    validate.process_workbook(in_path, out_path)
+    return None
+
+  # A job waits at most QUEUE_TIMEOUT seconds for a worker, then runs for at most JOB_TIMEOUT
+  # seconds, so we stop waiting only once the worker will no longer start it:
+  job = pool.apply_async(run_job, (validate.process_workbook, (in_path, out_path),
+                                   JOB_TIMEOUT, JOB_MEMORY, time.time() + QUEUE_TIMEOUT))
+  try:
+    job.get(QUEUE_TIMEOUT + JOB_TIMEOUT + GRACE_PERIOD)
+  except JobExpired:
+    return 'The server is busy; please try again later', 503
+  except (JobTimeout, multiprocessing.TimeoutError):
+    return 'Validation took longer than {} seconds'.format(JOB_TIMEOUT), 503
+  except MemoryError:
+    return 'Validation used more than {} MB of memory'.format(JOB_MEMORY >> 20), 413
+  return None
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -28,11 +136,63 @@ def my_app():
   out_path = tempdir + '/result.xlsx'
   os.makedirs(tempdir)
   f.save(in_path)
-  validate.process_workbook(in_path, out_path)
+  error = process_workbook(in_path, out_path)
+  if error:
+    return error
   return redirect(out_path)
 
 
 if __name__ == '__main__':
-  validate.load_nodes('nodes.dmp')
-  validate.load_names('names.dmp')
+  # In debug mode, Werkzeug's reloader reruns this script in a child process, which serves the
+  # requests, so only load the taxonomy and start the pool there:
+  if not get_debug_flag() or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    validate.load_nodes('nodes.dmp')
+    validate.load_names('names.dmp')
+    start_pool()
   app.run()
+
+
+# Unit tests:
+
+def test_run_job():
+  with multiprocessing.get_context('fork').Pool(1) as test_pool:
+    assert test_pool.apply_async(run_job, (sum, ([1, 2, 3],), 5, 1 << 30)).get(10) == 6
+
+    try:
+      test_pool.apply_async(run_job, (time.sleep, (10,), 1, None)).get(10)
+      assert False, 'expected JobTimeout'
+    except JobTimeout:
+      pass
+
+    try:
+      test_pool.apply_async(run_job, (bytearray, (1 << 30,), 5, 1 << 26)).get(10)
+      assert False, 'expected MemoryError'
+    except MemoryError:
+      pass
+
+    # The worker is still usable after a job fails:
+    assert test_pool.apply_async(run_job, (sum, ([4],), 5, 1 << 30)).get(10) == 4
+
+
+def test_run_job_queue():
+  import tempfile
+
+  with multiprocessing.get_context('fork').Pool(1) as test_pool, \
+       tempfile.TemporaryDirectory() as tmpdir:
+    # Queued jobs get their full timeout once they start, however long they waited:
+    start_by = time.time() + 10
+    jobs = [test_pool.apply_async(run_job, (time.sleep, (0.4,), 1, None, start_by))
+            for i in range(3)]
+    assert [job.get(10) for job in jobs] == [None, None, None]
+
+    # A job that is still queued when its caller gives up is not run:
+    busy = test_pool.apply_async(run_job, (time.sleep, (0.5,), 5, None))
+    path = os.path.join(tmpdir, 'ran')
+    queued = test_pool.apply_async(run_job, (os.mkdir, (path,), 5, None, time.time() + 0.1))
+    busy.get(10)
+    try:
+      queued.get(10)
+      assert False, 'expected JobExpired'
+    except JobExpired:
+      pass
+    assert not os.path.exists(path)